@@ -466,14 +466,22 @@ import cPickle
 import gzip
 
 def save_object(fname,obj,zip=0):
+    """Saves an object to disk, zipped if the file name ends in `.gz`.
+    The object is written to a temporary file that is then renamed,
+    so `fname` never holds a partially written object."""
     if zip==0 and fname.endswith(".gz"):
         zip = 1
-    if zip>0:
-        with gzip.GzipFile(fname,"wb") as stream:
-            cPickle.dump(obj,stream,2)
-    else:
-        with open(fname,"wb") as stream:
-            cPickle.dump(obj,stream,2)
+    temp = "%s.%d.tmp"%(fname,os.getpid())
+    try:
+        if zip>0:
+            with gzip.GzipFile(temp,"wb") as stream:
+                cPickle.dump(obj,stream,2)
+        else:
+            with open(temp,"wb") as stream:
+                cPickle.dump(obj,stream,2)
+        os.rename(temp,fname)
+    finally:
+        if os.path.exists(temp): os.unlink(temp)
 
 def unpickle_find_global(mname,cname):
     if mname=="lstm.lstm":
@@ -835,6 +843,25 @@ def quick_check_line_components(line_bin,dpi):
     there is probably something wrong."""
     return 1.0
 
+def check_line(image):
+    """Check whether `image` (a grayscale line image, text white on black)
+    looks like a text line that the line recognizers can handle. Returns
+    None if it does, and a description of the problem otherwise."""
+    if len(image.shape)==3: return "input image is color image %s"%(image.shape,)
+    if mean(image)<median(image): return "image may be inverted"
+    h,w = image.shape
+    if h<20: return "image not tall enough for a text line %s"%(image.shape,)
+    if h>200: return "image too tall for a text line %s"%(image.shape,)
+    if w<1.5*h: return "line too short %s"%(image.shape,)
+    if w>4000: return "line too long %s"%(image.shape,)
+    ratio = w*1.0/h
+    _,ncomps = measurements.label(image>mean(image))
+    lo = int(0.5*ratio+0.5)
+    hi = int(4*ratio)+1
+    if ncomps<lo: return "too few connected components (got %d, wanted >=%d)"%(ncomps,lo)
+    if ncomps>hi*ratio: return "too many connected components (got %d, wanted <=%d)"%(ncomps,hi)
+    return None
+
 def deprecated(func):
     """This is a decorator which can be used to mark functions
     as deprecated. It will result in a warning being emmitted
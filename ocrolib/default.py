@@ -6,6 +6,10 @@ ngraphs = "en-mixed-3.ngraphs.gz"
 space = "en-space.model.gz"
 lineest = "en-mixed.lineest.gz"
 
+# the socket used by ocropus-rserver and ocropus-rpred --server
+
+rserver = "/tmp/ocropus-rserver"
+
 # install the default models
 
 installable = [rnnmodel,model,ngraphs,space,lineest]
@@ -29,22 +29,32 @@ def extract_chars(segmentation,h=32,w=32,f=0.5,minscale=0.5):
     if amax(bin)==0: raise BadImage("segmentation came out empty")
     ls,ly,lx = vertical_stddev(bin)
     boxes = morph.find_objects(segmentation)
+    H,W = segmentation.shape
     for i,b in enumerate(boxes):
-        sub = (segmentation==i+1)
-        if amax(sub)==amin(sub): continue
-        cs,cy,cx = vertical_stddev(sub)
+        if b is None: continue
+        # pad the character with background, since it may fill its box
+        cs,cy,cx = vertical_stddev(pad(segmentation[b]==i+1,1,mode='constant'))
+        cy += b[0].start-1
+        cx += b[1].start-1
         # limit the character sigma to be at least minscale times the
         # line sigma (this causes dots etc. not to blow up ridiculously large)
         scale = f*h/(4*max(cs,minscale*ls))
         m = diag([1.0/scale,1.0/scale])
         offset = array([cy,cx])-dot(m,array([h/2,w/2]))
-        def transform(image,m=m,offset=offset):
-            return interpolation.affine_transform(1.0*image,m,offset=offset,order=1,output_shape=(h,w))
-        def itransform_add(result,image,m=m,cx=cx,cy=cy):
+        # both transformations only involve the part of the line image
+        # around the character, so they are carried out on that window
+        r = (max(h,w)/2+2)/scale+2
+        window = (slice(max(0,int(cy-r)),min(H,int(cy+r)+2)),
+                  slice(max(0,int(cx-r)),min(W,int(cx+r)+2)))
+        origin = array([window[0].start,window[1].start])
+        def transform(image,m=m,offset=offset,window=window,origin=origin):
+            return interpolation.affine_transform(1.0*image[window],m,offset=offset-origin,order=1,output_shape=(h,w))
+        def itransform_add(result,image,m=m,cx=cx,cy=cy,window=window,origin=origin):
             im = inv(m)
-            ioffset = array([h/2,w/2])-dot(im,array([cy,cx]))
-            result += interpolation.affine_transform(1.0*image,im,offset=ioffset,order=1,output_shape=segmentation.shape)
-        cimage = transform(sub)
+            ioffset = array([h/2,w/2])-dot(im,array([cy,cx]))+dot(im,origin)
+            output_shape = result[window].shape
+            result[window] += interpolation.affine_transform(1.0*image,im,offset=ioffset,order=1,output_shape=output_shape)
+        cimage = interpolation.affine_transform(1.0*(segmentation[window]==i+1),m,offset=offset-origin,order=1,output_shape=(h,w))
         yield cimage,transform,itransform_add
 
 
@@ -97,11 +107,12 @@ def compute_geomaps(fnames,shapedict,old_model,use_gt=1,size=32,debug=0,old_orde
         except:
             traceback.print_exc()
             continue
-        blimage = zeros(image.shape)
         h,w = image.shape
-        for x in range(w): blimage[clip(int(polyval(blp,x)),0,h-1),x] = 1
+        xs = arange(w)
+        blimage = zeros(image.shape)
+        blimage[clip(polyval(blp,xs).astype(int),0,h-1),xs] = 1
         xlimage = zeros(image.shape)
-        for x in range(w): xlimage[clip(int(polyval(xlp,x)),0,h-1),x] = 1
+        xlimage[clip(polyval(xlp,xs).astype(int),0,h-1),xs] = 1
         if debug>0 and fno%debug==0:
             subplot(413); imshow(xlimage+0.3*image)
             subplot(414); imshow(blimage+0.3*image)
@@ -110,12 +121,11 @@ def compute_geomaps(fnames,shapedict,old_model,use_gt=1,size=32,debug=0,old_orde
         except:
             continue
         if debug>0 and fno%debug==0: subplot(412); morph.showlabels(seg)
-        shape = None
-        for sub,transform,itransform_add in extract_chars(seg):
-            if shape is None: shape = sub.shape
-            assert sub.shape==shape
+        chars = list(extract_chars(seg))
+        if len(chars)==0: continue
+        bests = shapedict.predict(array([sub for sub,_,_ in chars]))
+        for (sub,transform,itransform_add),best in zip(chars,bests):
             count += 1
-            best = shapedict.predict1(sub)
             bls[best] += transform(blimage)
             xls[best] += transform(xlimage)
         if debug==1: ginput(1,100)
@@ -138,8 +148,11 @@ def blxlimages(image,shapedict,bls,xls):
     seg = morph.renumber_by_xcenter(seg)
     blimage = zeros(image.shape)
     xlimage = zeros(image.shape)
-    for sub,transform,itransform_add in extract_chars(seg):
-        best = shapedict.predict1(sub)
+    chars = list(extract_chars(seg))
+    if len(chars)==0: return blimage,xlimage
+    # classify all the characters of the line together
+    bests = shapedict.predict(array([sub for sub,_,_ in chars]))
+    for (sub,transform,itransform_add),best in zip(chars,bests):
         bli = bls[best].reshape(32,32)
         xli = xls[best].reshape(32,32)
         itransform_add(blimage,bli)
@@ -306,10 +319,12 @@ def scale_to_h(img,target_height,order=1,dtype=dtype('f'),cval=0):
     h,w = img.shape
     scale = target_height*1.0/h
     target_width = int(scale*w)
-    output = interpolation.affine_transform(1.0*img,eye(2)/scale,order=order,
+    # interpolation is carried out in double precision internally, so
+    # writing directly to the output type gives the same result as
+    # converting the input to double first
+    output = interpolation.affine_transform(img,eye(2)/scale,order=order,
                                             output_shape=(target_height,target_width),
-                                            mode='constant',cval=cval)
-    output = array(output,dtype=dtype)
+                                            mode='constant',cval=cval,output=dtype)
     return output
 
 class CenterNormalizer:
@@ -336,13 +351,39 @@ class CenterNormalizer:
             imshow(line,cmap=cm.gray)
             plot(self.center)
             ginput(1,1000)
+    def measure_fast(self,line):
+        """Like measure, but finds the center line on a copy of the line
+        downsampled to a height of about 16 pixels, where the large
+        smoothing filters are much cheaper. The result is close to, but
+        not the same as, that of measure."""
+        h,w = line.shape
+        k = max(1,h//16)
+        if k==1: return self.measure(line)
+        hs,ws = h//k,w//k
+        small = line[:hs*k,:ws*k].reshape(hs,k,ws,k).mean(axis=3).mean(axis=1)
+        smoothed = filters.gaussian_filter(small,(h*0.5/k,h*self.smoothness/k),mode='constant')
+        smoothed += 0.001*filters.uniform_filter(smoothed,(h*0.5/k,ws),mode='constant')
+        self.shape = (h,w)
+        a = (argmax(smoothed,axis=0)+0.5)*k-0.5
+        a = interp(arange(w),(arange(ws)+0.5)*k-0.5,a)
+        a = filters.gaussian_filter1d(a,h*self.extra)
+        self.center = array(a,'i')
+        deltas = abs(arange(h)[:,newaxis]-self.center[newaxis,:])
+        self.mad = mean(deltas[line!=0])
+        self.r = int(1+self.range*self.mad)
+    def measure_and_normalize(self,line,img,order=1,dtype=dtype('f'),cval=0):
+        """Measure `line` with measure_fast and return `img`
+        normalized accordingly."""
+        self.measure_fast(line)
+        return self.normalize(img,order=order,dtype=dtype,cval=cval)
     def dewarp(self,img,cval=0,dtype=dtype('f')):
         assert img.shape==self.shape
         h,w = img.shape
-        padded = vstack([cval*ones((h,w)),img,cval*ones((h,w))])
-        center = self.center+h
-        dewarped = [padded[center[i]-self.r:center[i]+self.r,i] for i in range(w)]
-        dewarped = array(dewarped,dtype=dtype).T
+        # gather the 2r pixels around the center of each column,
+        # filling in cval for rows outside the image
+        ys = self.center[newaxis,:]+arange(-self.r,self.r)[:,newaxis]
+        dewarped = array(img[clip(ys,0,h-1),arange(w)[newaxis,:]],dtype=dtype)
+        dewarped[(ys<0)|(ys>=h)] = cval
         return dewarped
     def normalize(self,img,order=1,dtype=dtype('f'),cval=0):
         dewarped = self.dewarp(img,cval=cval,dtype=dtype)
@@ -132,7 +132,7 @@ def ccslineseg(image,debug=0):
     center = filters.maximum_filter(center,(2,2))
     center,_ = morph.label(center)
     center = morph.spread_labels(center)
-    center *= image
+    center *= (image>0)
     return center
 
 class SimpleParams:
@@ -28,6 +28,9 @@ import common as ocrolib
 import pdb
 from pylab import *
 import sys
+import math
+import time
+import threading
 from collections import defaultdict
 from ocrolib.native import *
 from ocrolib import edist
@@ -40,16 +43,16 @@ class RangeError(Exception):
     def __init__(self,s=None):
         Exception.__init__(self,s)
 
-def prepare_line(line,pad=16):
+def prepare_line(line,pad=16,dtype='d'):
     """Prepare a line for recognition; this inverts it, transposes
-    it, and pads it."""
+    it, and pads it. The result has the given `dtype`."""
     line = line * 1.0/amax(line)
     line = amax(line)-line
     line = line.T
     if pad>0:
         w = line.shape[1]
         line = vstack([zeros((pad,w)),line,zeros((pad,w))])
-    return line
+    return asarray(line,dtype)
 
 def randu(*shape):
     """Generate uniformly random values in the range (-1,1).
@@ -122,6 +125,15 @@ class Network:
         """Prediction is the same as forward propagation."""
         return self.forward(xs)
 
+    def forward_batch(self,xss):
+        """Propagate a batch of sequences (possibly of different lengths)
+        forward through the network and return a list of 2D output arrays.
+        This is used for inference only; unlike `forward`, it need not
+        update the internal state for a subsequent call to `backward`.
+        Subclasses can override this with implementations that process
+        all the sequences together."""
+        return [array(self.forward(xs)) for xs in xss]
+
     def train(self,xs,ys,debug=0):
         """Training performs forward propagation, computes the output deltas
         as the difference between the predicted and desired values,
@@ -187,6 +199,21 @@ class Network:
         self.learning_rate = r
         self.momentum = momentum
 
+    def setConcurrent(self,flag):
+        """Run independent component networks (e.g., the two directions of
+        a bidirectional LSTM) in separate threads. This only affects the
+        combination classes; it is a no-op for simple networks."""
+        pass
+
+    def strip(self):
+        """Remove everything that is only needed for training (momentum,
+        activations and deltas from the last pass, etc.), so that the
+        network can be saved compactly for inference. Subclasses extend
+        this for their own training state."""
+        for v in "deltas state batch_state".split():
+            self.__dict__.pop(v,None)
+        self.stripped = 1
+
     def weights(self):
         """Return an iterator that iterates over (W,DW,name) triples
         representing the weight matrix, the computed deltas, and the names
@@ -204,6 +231,16 @@ class Network:
         derivs = [d.ravel() for d in derivs]
         return concatenate(weights),concatenate(derivs)
 
+    def setWeights(self,weights=None,derivs=None):
+        """Set all the weights and/or derivatives from single vectors laid out
+        as returned by `allweights`. This is used for copying weights and
+        gradients between processes."""
+        i = 0
+        for w,dw,n in self.weights():
+            k = w.size
+            if weights is not None: w[...] = weights[i:i+k].reshape(w.shape)
+            if derivs is not None: dw[...] = derivs[i:i+k].reshape(dw.shape)
+            i += k
     def update(self):
         """Update the weights using the deltas computed in the last forward/backward pass.
         Subclasses need not implement this, they should implement the `weights` method."""
@@ -236,6 +273,18 @@ class Network:
         the `update` method)."""
         pass
 
+    def forward_batch_train(self,xss):
+        """Like `forward_batch`, but keeps the internal state needed for
+        a subsequent call to `backward_batch`."""
+        pass
+
+    def backward_batch(self,deltass):
+        """Propagate a list of error signals for the sequences of the last
+        `forward_batch_train` backward through the network. The derivatives
+        are summed over all the sequences, so a single `update` performs
+        one mini-batch step."""
+        pass
+
 '''
 
 class Logreg(Network):
@@ -296,9 +345,11 @@ class Softmax(Network):
         n = len(ys)
         inputs,zs = [None]*n,[None]*n
         for i in range(n):
-            inputs[i] = concatenate([ones(1),ys[i]])
+            inputs[i] = concatenate([ones(1,self.W2.dtype),ys[i]])
             temp = dot(self.W2,inputs[i])
-            temp = exp(clip(temp,-100,100))
+            # shifting by the maximum avoids overflow in single precision
+            temp = clip(temp,-100,100)
+            temp = exp(temp-amax(temp))
             temp /= sum(temp)
             zs[i] = temp
         self.state = (inputs,zs)
@@ -313,6 +364,38 @@ class Softmax(Network):
             dys[i] = dot(dzspre[i],self.W2)[1:]
         self.DW2 = sumouter(dzspre,inputs)
         return dys
+    def forward_batch(self,xss):
+        """Forward propagate a batch of sequences, computing the outputs
+        for all time steps of all sequences with a single matrix product."""
+        lengths = [len(ys) for ys in xss]
+        temp = dot(concatenate(xss),self.W2[:,1:].T)+self.W2[:,0]
+        temp = clip(temp,-100,100)
+        temp = exp(temp-amax(temp,axis=1)[:,newaxis])
+        temp /= sum(temp,axis=1)[:,newaxis]
+        return split(temp,cumsum(lengths)[:-1])
+    def forward_batch_train(self,xss):
+        inputs = concatenate(xss)
+        inputs = concatenate([ones((len(inputs),1),inputs.dtype),inputs],axis=1)
+        self.batch_state = inputs
+        return self.forward_batch(xss)
+    def backward_batch(self,deltass):
+        lengths = [len(deltas) for deltas in deltass]
+        deltas = concatenate(deltass)
+        self.DW2 = dot(deltas.T,self.batch_state)
+        dys = dot(deltas,self.W2[:,1:])
+        return split(dys,cumsum(lengths)[:-1])
+    def setDtype(self,dtype):
+        """Convert the weights to the given `dtype`."""
+        self.W2 = array(self.W2,dtype)
+        self.DW2 = array(self.DW2,dtype)
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("batch_state",None)
+        if getattr(self,"stripped",0): del state["DW2"]
+        return state
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        if "DW2" not in state: self.DW2 = zeros(self.W2.shape,self.W2.dtype)
     def info(self):
         vars = sorted("W2".split())
         for v in vars:
@@ -397,45 +480,136 @@ def hprime(x,y=None):
 # However, that is several times slower and the extra abstraction
 # isn't actually all that useful.
 
-def forward_py(n,N,ni,ns,na,xs,source,gix,gfx,gox,cix,gi,gf,go,ci,state,output,WGI,WGF,WGO,WCI,WIP,WFP,WOP):
-    """Perform forward propagation of activations for a simple LSTM layer."""
+def forward_py(n,N,ni,ns,na,xs,source,gx,gi,gf,go,ci,state,output,WG,WIP,WFP,WOP):
+    """Perform forward propagation of activations for a simple LSTM layer.
+    `WG` and `gx` hold the weights and net inputs for the input, forget,
+    and output gates and the cell input, stacked in that order."""
+    # The bias and input parts of `source` don't depend on the recurrence,
+    # so their contribution to all the gates is computed for all time steps
+    # with a single matrix product using the stacked gate weights. Only the
+    # recurrent part remains inside the loop.
+    source[:n,0] = 1
+    source[:n,1:1+ni] = xs[:n]
+    source[0,1+ni:] = 0
+    dot(source[:n,:1+ni],WG[:,:1+ni].T,out=gx[:n])
+    WR = ascontiguousarray(WG[:,1+ni:])
     for t in range(n):
-        prev = zeros(ns) if t==0 else output[t-1]
-        source[t,0] = 1
-        source[t,1:1+ni] = xs[t]
-        source[t,1+ni:] = prev
-        dot(WGI,source[t],out=gix[t])
-        dot(WGF,source[t],out=gfx[t])
-        dot(WGO,source[t],out=gox[t])
-        dot(WCI,source[t],out=cix[t])
         if t>0:
-            gix[t] += WIP*state[t-1]
-            gfx[t] += WFP*state[t-1]
-        gi[t] = ffunc(gix[t])
-        gf[t] = ffunc(gfx[t])
-        ci[t] = gfunc(cix[t])
+            gx[t] += dot(WR,output[t-1])
+            gx[t,:ns] += WIP*state[t-1]
+            gx[t,ns:2*ns] += WFP*state[t-1]
+        gi[t] = ffunc(gx[t,:ns])
+        gf[t] = ffunc(gx[t,ns:2*ns])
+        ci[t] = gfunc(gx[t,3*ns:])
         state[t] = ci[t]*gi[t]
         if t>0:
             state[t] += gf[t]*state[t-1]
-            gox[t] += WOP*state[t]
-        go[t] = ffunc(gox[t])
+            gx[t,2*ns:3*ns] += WOP*state[t]
+        go[t] = ffunc(gx[t,2*ns:3*ns])
         output[t] = hfunc(state[t]) * go[t]
+    source[1:n,1+ni:] = output[:n-1]
     assert not isnan(output[:n]).any()
 
+def forward_batch_py(xs,WG,WIP,WFP,WOP,keep=0):
+    """Perform forward propagation of activations for a simple LSTM layer
+    on a batch of sequences at once. `xs` is a `(n,b,ni)` array holding
+    `b` input sequences of length `n`; the result is a `(n,b,ns)` array.
+    Since the layer is causal, sequences shorter than `n` can simply be
+    padded at the end. Each time step is computed with matrix-matrix
+    products over the whole batch. If `keep` is set, the gate activations
+    and states needed by `backward_batch_py` are returned as well, as a
+    tuple `(gi,gf,go,ci,state,output)`."""
+    n,b,ni = xs.shape
+    ns = len(WIP)
+    gx = dot(xs.reshape(n*b,ni),WG[:,1:1+ni].T).reshape(n,b,4*ns)
+    gx += WG[:,0]
+    WR = ascontiguousarray(WG[:,1+ni:].T)
+    output = zeros((n,b,ns),WG.dtype)
+    if keep:
+        gis,gfs,gos,cis,states = [zeros((n,b,ns),WG.dtype) for i in range(5)]
+    state = zeros((b,ns),WG.dtype)
+    for t in range(n):
+        g = gx[t]
+        if t>0:
+            g += dot(output[t-1],WR)
+            g[:,:ns] += WIP*state
+            g[:,ns:2*ns] += WFP*state
+        gi = ffunc(g[:,:ns])
+        gf = ffunc(g[:,ns:2*ns])
+        ci = gfunc(g[:,3*ns:])
+        if t>0:
+            state = ci*gi+gf*state
+            g[:,2*ns:3*ns] += WOP*state
+        else:
+            state = ci*gi
+        go = ffunc(g[:,2*ns:3*ns])
+        output[t] = hfunc(state) * go
+        if keep:
+            gis[t],gfs[t],gos[t],cis[t],states[t] = gi,gf,go,ci,state
+    if keep: return gis,gfs,gos,cis,states,output
+    return output
+
+def backward_batch_py(xs,deltas,gi,gf,go,ci,state,output,WG,WIP,WFP,WOP):
+    """Perform backward propagation of deltas for a batch of sequences
+    after `forward_batch_py(...,keep=1)`. All arrays are laid out as
+    `(n,b,...)`. Padding at the end of the sequences must have zero deltas;
+    it then contributes nothing to the derivatives. Returns the deltas
+    for the inputs and the derivatives `(DWG,DWIP,DWFP,DWOP)`, summed
+    over the batch."""
+    n,b,ni = xs.shape
+    ns = len(WIP)
+    gerr = zeros((n,b,4*ns),WG.dtype)
+    WR = WG[:,1+ni:]
+    for t in reversed(range(n)):
+        gierr = gerr[t,:,:ns]
+        gferr = gerr[t,:,ns:2*ns]
+        goerr = gerr[t,:,2*ns:3*ns]
+        cierr = gerr[t,:,3*ns:]
+        outerr = array(deltas[t])
+        if t<n-1:
+            outerr += dot(gerr[t+1],WR)
+        goerr[:] = fprime(None,go[t]) * hfunc(state[t]) * outerr
+        stateerr = hprime(state[t]) * go[t] * outerr
+        stateerr += goerr*WOP
+        if t<n-1:
+            stateerr += gerr[t+1,:,ns:2*ns]*WFP
+            stateerr += gerr[t+1,:,:ns]*WIP
+            stateerr += nextstateerr*gf[t+1]
+        if t>0:
+            gferr[:] = fprime(None,gf[t])*stateerr*state[t-1]
+        gierr[:] = fprime(None,gi[t])*stateerr*ci[t]
+        cierr[:] = gprime(None,ci[t])*stateerr*gi[t]
+        nextstateerr = stateerr
+    DWIP = sum(gerr[1:,:,:ns]*state[:-1],axis=(0,1))
+    DWFP = sum(gerr[1:,:,ns:2*ns]*state[:-1],axis=(0,1))
+    DWOP = sum(gerr[:,:,2*ns:3*ns]*state,axis=(0,1))
+    source = concatenate([ones((n,b,1),WG.dtype),xs,
+                          concatenate([zeros((1,b,ns),WG.dtype),output[:-1]])],axis=2)
+    gerr = gerr.reshape(n*b,4*ns)
+    DWG = dot(gerr.T,source.reshape(n*b,-1))
+    xerr = dot(gerr,WG[:,1:1+ni]).reshape(n,b,ni)
+    return xerr,(DWG,DWIP,DWFP,DWOP)
 
 def backward_py(n,N,ni,ns,na,deltas,
                     source,
-                    gix,gfx,gox,cix,
                     gi,gf,go,ci,
                     state,output,
-                    WGI,WGF,WGO,WCI,
+                    WG,
                     WIP,WFP,WOP,
                     sourceerr,
-                    gierr,gferr,goerr,cierr,
+                    gerr,
                     stateerr,outerr,
-                    DWGI,DWGF,DWGO,DWCI,
+                    DWG,
                     DWIP,DWFP,DWOP):
-    """Perform backward propagation of deltas for a simple LSTM layer."""
+    """Perform backward propagation of deltas for a simple LSTM layer.
+    `WG`, `DWG`, and `gerr` hold the weights, derivatives, and deltas for
+    the gates and the cell input, stacked in the same order as for
+    `forward_py`."""
+    gierr = gerr[:,:ns]
+    gferr = gerr[:,ns:2*ns]
+    goerr = gerr[:,2*ns:3*ns]
+    cierr = gerr[:,3*ns:]
+    gferr[0] = 0
     for t in reversed(range(n)):
         outerr[t] = deltas[t]
         if t<n-1:
@@ -451,29 +625,79 @@ def backward_py(n,N,ni,ns,na,deltas,
             gferr[t] = fprime(None,gf[t])*stateerr[t]*state[t-1]
         gierr[t] = fprime(None,gi[t])*stateerr[t]*ci[t] # gfunc(cix[t])
         cierr[t] = gprime(None,ci[t])*stateerr[t]*gi[t]
-        dot(gierr[t],WGI,out=sourceerr[t])
-        if t>0:
-            sourceerr[t] += dot(gferr[t],WGF)
-        sourceerr[t] += dot(goerr[t],WGO)
-        sourceerr[t] += dot(cierr[t],WCI)
-    DWIP = nutils.sumprod(gierr[1:n],state[:n-1],out=DWIP)
-    DWFP = nutils.sumprod(gferr[1:n],state[:n-1],out=DWFP)
-    DWOP = nutils.sumprod(goerr[:n],state[:n],out=DWOP)
-    DWGI = nutils.sumouter(gierr[:n],source[:n],out=DWGI)
-    DWGF = nutils.sumouter(gferr[1:n],source[1:n],out=DWGF)
-    DWGO = nutils.sumouter(goerr[:n],source[:n],out=DWGO)
-    DWCI = nutils.sumouter(cierr[:n],source[:n],out=DWCI)
+        dot(gerr[t],WG,out=sourceerr[t])
+    DWIP[:] = sum(gierr[1:n]*state[:n-1],axis=0)
+    DWFP[:] = sum(gferr[1:n]*state[:n-1],axis=0)
+    DWOP[:] = sum(goerr[:n]*state[:n],axis=0)
+    dot(gerr[:n].T,source[:n],out=DWG)
+
+# the state variables of LSTM as stored by older versions
+
+legacy_state_vars = "cix ci gix gi gox go gfx gf state output"
+legacy_state_vars += " gierr gferr goerr cierr stateerr outerr source sourceerr"
 
 class LSTM(Network):
     """A standard LSTM network. This is a direct implementation of all the forward
     and backward propagation formulas, mainly for speed. (There is another, more
     abstract implementation as well, but that's significantly slower in Python
-    due to function call overhead.)"""
+    due to function call overhead.)
+
+    Internally, the weights of the gates and the cell input are kept in a single
+    fused `(4*ns,na)` matrix `WG`; `WGI`, `WGF`, `WGO`, and `WCI` are views into it
+    (and similarly for the derivatives and state variables). Pickles contain only
+    the individual matrices, so they remain compatible with older versions.
+
+    By default, weights and state variables are double precision; `setDtype`
+    can convert them to single precision for faster inference.
+
+    State variables are allocated on demand and grow with the length of the
+    sequences processed, up to `maxlen`. If `debug` is set, they are filled
+    with `nan` before each forward propagation to catch uses of stale values."""
+    gates = "WGI WGF WGO WCI".split()
+    dtype = 'd'
+    debug = 0
+    growth = 1.5
     def __init__(self,ni,ns,initial=initial_range,maxlen=5000):
         na = 1+ni+ns
         self.dims = ni,ns,na
+        self.maxlen = maxlen
         self.init_weights(initial)
-        self.allocate(maxlen)
+        self.allocate(0)
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # the state variables are reallocated on demand after loading
+        vars = "WG DWG gx gerr batch_state"
+        vars += " ci gi go gf cix gix gox gfx cierr gierr goerr gferr"
+        vars += " state output stateerr outerr source sourceerr"
+        for v in vars.split():
+            state.pop(v,None)
+        if getattr(self,"stripped",0):
+            for w in self.gates+"WIP WFP WOP".split():
+                del state["D"+w]
+            return state
+        # older versions expect NaN-filled state variables of length maxlen
+        # in the pickle (they compress to almost nothing); they are
+        # discarded again when loading; stripped networks can't be loaded
+        # by older versions anyway, so they go without
+        ni,ns,na = self.dims
+        for v in legacy_state_vars.split():
+            state[v] = nan*ones((self.maxlen,na if "source" in v else ns))
+        return state
+    def __setstate__(self,state):
+        state = dict(state)
+        if "maxlen" not in state: state["maxlen"] = len(state["gi"])
+        for v in legacy_state_vars.split():
+            state.pop(v,None)
+        self.__dict__.update(state)
+        self.fuse_weights()
+        self.allocate(0)
+    def strip(self):
+        """Remove the momentum and the internal state variables, and
+        leave the derivatives out of pickles. Derivatives are recreated as
+        zeros when the network is loaded again, and state variables are
+        allocated on demand to the length of the sequences actually processed."""
+        Network.strip(self)
+        self.allocate(0)
     def ninputs(self):
         return self.dims[0]
     def noutputs(self):
@@ -486,13 +710,37 @@ class LSTM(Network):
         "Initialize the weight matrices and derivatives"
         ni,ns,na = self.dims
         # gate weights
-        for w in "WGI WGF WGO WCI".split():
-            setattr(self,w,randu(ns,na)*initial)
-            setattr(self,"D"+w,zeros((ns,na)))
+        self.WG = randu(4*ns,na)*initial
+        self.DWG = zeros((4*ns,na))
+        self.fuse_weights()
         # peep weights
         for w in "WIP WFP WOP".split():
             setattr(self,w,randu(ns)*initial)
             setattr(self,"D"+w,zeros(ns))
+    def fuse_weights(self):
+        """Make the individual gate weight and derivative matrices views
+        into the fused matrices `WG` and `DWG`, constructing the fused matrices
+        from the individual ones first if necessary (e.g., after unpickling)."""
+        ni,ns,na = self.dims
+        if "DWG" not in self.__dict__ and "DWGI" not in self.__dict__:
+            # derivatives are left out of stripped networks
+            self.DWG = zeros(self.WG.shape if "WG" in self.__dict__ else (4*ns,na),self.dtype)
+            for w in "WIP WFP WOP".split():
+                setattr(self,"D"+w,zeros(ns,self.dtype))
+        for w in ["WG","DWG"]:
+            if w not in self.__dict__:
+                setattr(self,w,vstack([getattr(self,w[:-2]+g) for g in self.gates]))
+            for i,g in enumerate(self.gates):
+                setattr(self,w[:-2]+g,getattr(self,w)[i*ns:(i+1)*ns])
+    def setDtype(self,dtype):
+        """Convert the weights and the internal state variables to the
+        given `dtype`. Single precision ('f') is intended for inference;
+        it halves the memory traffic of the forward propagation."""
+        self.dtype = dtype
+        for w in "WG DWG WIP DWIP WFP DWFP WOP DWOP".split():
+            setattr(self,w,array(getattr(self,w),dtype))
+        self.fuse_weights()
+        self.allocate(len(self.gi))
     def weights(self):
         "Yields all the weight and derivative matrices"
         weights = "WGI WGF WGO WCI WIP WFP WOP"
@@ -509,21 +757,36 @@ class LSTM(Network):
             print v,a.shape,amin(a),amax(a)
     def allocate(self,n):
         """Allocate space for the internal state variables.
-        `n` is the maximum sequence length that can be processed."""
+        `n` is the maximum sequence length that can be processed
+        without reallocation."""
         ni,ns,na = self.dims
-        vars = "cix ci gix gi gox go gfx gf"
-        vars += " state output gierr gferr goerr cierr stateerr outerr"
+        vars = "ci gi go gf"
+        vars += " state output stateerr outerr"
         for v in vars.split():
-            setattr(self,v,nan*ones((n,ns)))
-        self.source = nan*ones((n,na))
-        self.sourceerr = nan*ones((n,na))
+            setattr(self,v,nan*ones((n,ns),self.dtype))
+        self.gx = nan*ones((n,4*ns),self.dtype)
+        self.gerr = nan*ones((n,4*ns),self.dtype)
+        for i,v in enumerate("gi gf go ci".split()):
+            setattr(self,v+"x",self.gx[:,i*ns:(i+1)*ns])
+            setattr(self,v+"err",self.gerr[:,i*ns:(i+1)*ns])
+        self.source = nan*ones((n,na),self.dtype)
+        self.sourceerr = nan*ones((n,na),self.dtype)
+    def grow(self,n):
+        """Make sure that sequences of length `n` can be processed,
+        growing the internal state variables geometrically if necessary
+        (so that reallocation only happens rarely)."""
+        if n>self.maxlen: raise ocrolib.RecognitionError("input too large for LSTM model")
+        N = len(self.gi)
+        if n<=N: return
+        self.allocate(min(self.maxlen,max(n,int(self.growth*N))))
     def reset(self,n):
-        """Reset the contents of the internal state variables to `nan`"""
-        vars = "cix ci gix gi gox go gfx gf"
-        vars += " state output gierr gferr goerr cierr stateerr outerr"
+        """Reset the contents of the internal state variables for the
+        first `n` time steps to `nan`"""
+        vars = "ci gi go gf gx gerr"
+        vars += " state output stateerr outerr"
         vars += " source sourceerr"
         for v in vars.split():
-            getattr(self,v)[:,:] = nan
+            getattr(self,v)[:n,:] = nan
     def forward(self,xs):
         """Perform forward propagation of activations and update the 
         internal state for a subsequent call to `backward`.
@@ -535,18 +798,61 @@ class LSTM(Network):
         assert len(xs[0])==ni
         n = len(xs)
         self.last_n = n
+        self.grow(n)
         N = len(self.gi)
-        if n>N: raise ocrolib.RecognitionError("input too large for LSTM model")
-        self.reset(n)
+        if self.debug: self.reset(n)
         forward_py(n,N,ni,ns,na,xs,
                    self.source,
-                   self.gix,self.gfx,self.gox,self.cix,
+                   self.gx,
                    self.gi,self.gf,self.go,self.ci,
                    self.state,self.output,
-                   self.WGI,self.WGF,self.WGO,self.WCI,
+                   self.WG,
                    self.WIP,self.WFP,self.WOP)
         assert not isnan(self.output[:n]).any()
         return self.output[:n]
+    def pad_batch(self,xss,k):
+        """Pack a list of sequences of `k`-dimensional vectors into a
+        `(n,b,k)` array, padding them with zeros at the end."""
+        n = max([len(xs) for xs in xss])
+        if n>self.maxlen: raise ocrolib.RecognitionError("input too large for LSTM model")
+        batch = zeros((n,len(xss),k),self.dtype)
+        for i,xs in enumerate(xss):
+            assert len(xs[0])==k
+            batch[:len(xs),i] = xs
+        return batch
+    def forward_batch(self,xss):
+        """Perform forward propagation of activations for a list of input
+        sequences at once. The sequences are padded at the end to the
+        length of the longest one, so each time step is a matrix-matrix
+        product over the batch. Does not update the internal state
+        used by `backward`. Returns a list of 2D output arrays."""
+        ni,ns,na = self.dims
+        lengths = [len(xs) for xs in xss]
+        batch = self.pad_batch(xss,ni)
+        output = forward_batch_py(batch,self.WG,self.WIP,self.WFP,self.WOP)
+        return [output[:l,i] for i,l in enumerate(lengths)]
+    def forward_batch_train(self,xss):
+        """Like `forward_batch`, but keeps the activations of the whole
+        batch for a subsequent call to `backward_batch`."""
+        ni,ns,na = self.dims
+        lengths = [len(xs) for xs in xss]
+        batch = self.pad_batch(xss,ni)
+        acts = forward_batch_py(batch,self.WG,self.WIP,self.WFP,self.WOP,keep=1)
+        self.batch_state = (lengths,batch,acts)
+        output = acts[-1]
+        return [output[:l,i] for i,l in enumerate(lengths)]
+    def backward_batch(self,deltass):
+        """Perform backward propagation of deltas for the sequences of the
+        last `forward_batch_train`. The derivatives are summed over the batch.
+        Returns the list of deltas for the input sequences."""
+        ni,ns,na = self.dims
+        lengths,batch,acts = self.batch_state
+        assert lengths==[len(deltas) for deltas in deltass]
+        deltas = self.pad_batch(deltass,ns)
+        xerr,derivs = backward_batch_py(batch,deltas,*(acts+(self.WG,self.WIP,self.WFP,self.WOP)))
+        for w,dw in zip("DWG DWIP DWFP DWOP".split(),derivs):
+            getattr(self,w)[:] = dw
+        return [xerr[:l,i] for i,l in enumerate(lengths)]
     def backward(self,deltas):
         """Perform backward propagation of deltas. Must be called after `forward`.
         Does not perform weight updating (for that, use the generic `update` method).
@@ -558,15 +864,14 @@ class LSTM(Network):
         if n>N: raise ocrolib.RecognitionError("input too large for LSTM model")
         backward_py(n,N,ni,ns,na,deltas,
                     self.source,
-                    self.gix,self.gfx,self.gox,self.cix,
                     self.gi,self.gf,self.go,self.ci,
                     self.state,self.output,
-                    self.WGI,self.WGF,self.WGO,self.WCI,
+                    self.WG,
                     self.WIP,self.WFP,self.WOP,
                     self.sourceerr,
-                    self.gierr,self.gferr,self.goerr,self.cierr,
+                    self.gerr,
                     self.stateerr,self.outerr,
-                    self.DWGI,self.DWGF,self.DWGO,self.DWCI,
+                    self.DWG,
                     self.DWIP,self.DWFP,self.DWOP)
         return [s[1:1+ni] for s in self.sourceerr[:n]]
 
@@ -588,6 +893,18 @@ class Stacked(Network):
         for i,net in enumerate(self.nets):
             xs = net.forward(xs)
         return xs
+    def forward_batch(self,xss):
+        for i,net in enumerate(self.nets):
+            xss = net.forward_batch(xss)
+        return xss
+    def forward_batch_train(self,xss):
+        for i,net in enumerate(self.nets):
+            xss = net.forward_batch_train(xss)
+        return xss
+    def backward_batch(self,deltass):
+        for i,net in reversed(list(enumerate(self.nets))):
+            deltass = net.backward_batch(deltass)
+        return deltass
     def backward(self,deltas):
         self.ldeltas = [deltas]
         for i,net in reversed(list(enumerate(self.nets))):
@@ -604,6 +921,18 @@ class Stacked(Network):
             net.info()
     def states(self):
         return self.nets[0].states()
+    def setDtype(self,dtype):
+        for net in self.nets:
+            net.setDtype(dtype)
+    def setConcurrent(self,flag):
+        for net in self.nets:
+            net.setConcurrent(flag)
+    def strip(self):
+        Network.strip(self)
+        self.__dict__.pop("ldeltas",None)
+        self.dstats = defaultdict(list)
+        for net in self.nets:
+            net.strip()
     def weights(self):
         for i,net in enumerate(self.nets):
             for w,dw,n in net.weights():
@@ -619,6 +948,17 @@ class Reversed(Network):
         return self.net.noutputs()
     def forward(self,xs):
         return self.net.forward(xs[::-1])[::-1]
+    def forward_batch(self,xss):
+        # each sequence is reversed separately, so that padding
+        # always ends up at the end of the reversed sequences
+        outputs = self.net.forward_batch([xs[::-1] for xs in xss])
+        return [ys[::-1] for ys in outputs]
+    def forward_batch_train(self,xss):
+        outputs = self.net.forward_batch_train([xs[::-1] for xs in xss])
+        return [ys[::-1] for ys in outputs]
+    def backward_batch(self,deltass):
+        result = self.net.backward_batch([deltas[::-1] for deltas in deltass])
+        return [d[::-1] for d in result] if result is not None else None
     def backward(self,deltas):
         result = self.net.backward(deltas[::-1])
         return result[::-1] if result is not None else None
@@ -626,27 +966,87 @@ class Reversed(Network):
         self.net.info()
     def states(self):
         return self.net.states()[::-1]
+    def setDtype(self,dtype):
+        self.net.setDtype(dtype)
+    def setConcurrent(self,flag):
+        self.net.setConcurrent(flag)
+    def strip(self):
+        Network.strip(self)
+        self.net.strip()
     def weights(self):
         for w,dw,n in self.net.weights():
             yield w,dw,"Reversed/%s"%n
 
+def run_threads(jobs):
+    """Call each of the given functions (taking no arguments) in a thread
+    of its own and return the list of their results. This is useful for
+    networks that are independent of each other, since NumPy releases
+    the global interpreter lock inside BLAS and most array operations.
+    An exception raised in any of the threads is re-raised. The floating
+    point error handling of the calling thread applies to the jobs (NumPy
+    keeps it per thread)."""
+    results = [None]*len(jobs)
+    errors = []
+    err = geterr()
+    def run(i):
+        try:
+            with errstate(**err):
+                results[i] = jobs[i]()
+        except:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run,args=(i,)) for i in range(len(jobs))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if len(errors)>0:
+        raise errors[0][0],errors[0][1],errors[0][2]
+    return results
+
 class Parallel(Network):
-    """Run multiple networks in parallel on the same input."""
+    """Run multiple networks in parallel on the same input.
+    If `concurrent` is set, the networks run in separate threads."""
+    concurrent = 0
     def __init__(self,*nets):
         self.nets = nets
+    def __getstate__(self):
+        # running concurrently is a runtime choice, not part of the model
+        state = dict(self.__dict__)
+        state.pop("concurrent",None)
+        return state
+    def map(self,f):
+        """Call `f(i,net)` for each of the component networks, concurrently
+        if requested, and return the list of results."""
+        if self.concurrent:
+            return run_threads([lambda i=i,net=net: f(i,net) for i,net in enumerate(self.nets)])
+        else:
+            return [f(i,net) for i,net in enumerate(self.nets)]
     def forward(self,xs):
-        outputs = [net.forward(xs) for net in self.nets]
+        outputs = self.map(lambda i,net: net.forward(xs))
         outputs = zip(*outputs)
         outputs = [concatenate(l) for l in outputs]
         return outputs
+    def forward_batch(self,xss):
+        outputs = self.map(lambda i,net: net.forward_batch(xss))
+        outputs = zip(*outputs)
+        outputs = [concatenate(l,axis=1) for l in outputs]
+        return outputs
+    def forward_batch_train(self,xss):
+        outputs = self.map(lambda i,net: net.forward_batch_train(xss))
+        outputs = zip(*outputs)
+        outputs = [concatenate(l,axis=1) for l in outputs]
+        return outputs
+    def backward_batch(self,deltass):
+        ks = cumsum([0]+[net.noutputs() for net in self.nets])
+        self.map(lambda i,net: net.backward_batch([d[:,ks[i]:ks[i+1]] for d in deltass]))
+        return None
     def backward(self,deltas):
         deltas = array(deltas)
-        start = 0
-        for i,net in enumerate(self.nets):
-            k = net.noutputs()
-            net.backward(deltas[:,start:start+k])
-            start += k
+        ks = cumsum([0]+[net.noutputs() for net in self.nets])
+        self.map(lambda i,net: net.backward(deltas[:,ks[i]:ks[i+1]]))
         return None
+    def setConcurrent(self,flag):
+        self.concurrent = flag
+        for net in self.nets:
+            net.setConcurrent(flag)
     def info(self):
         for net in self.nets:
             net.info()
@@ -655,6 +1055,13 @@ class Parallel(Network):
         outputs = zip(*outputs)
         outputs = [concatenate(l) for l in outputs]
         return outputs
+    def setDtype(self,dtype):
+        for net in self.nets:
+            net.setDtype(dtype)
+    def strip(self):
+        Network.strip(self)
+        for net in self.nets:
+            net.strip()
     def weights(self):
         for i,net in enumerate(self.nets):
             for w,dw,n in net.weights():
@@ -730,6 +1137,148 @@ def translate_back(outputs,threshold=0.7,pos=0):
     if pos: return maxima
     return [c for (r,c) in maxima]
 
+def log_sum(x,y):
+    "Add two scalar log probabilities (Python floats, for speed)."
+    if x<y: x,y = y,x
+    if y==-inf: return x
+    return x+math.log1p(math.exp(y-x))
+
+class NGraphsScorer:
+    """Scores the extension of recognized prefixes by a character
+    using an `ocrolib.ngraphs` model. Costs are negative log posteriors
+    (with `missing` for characters the model doesn't know about, and for
+    rejects, "~"), and they are cached by context."""
+    def __init__(self,lm,codec,missing=15.0):
+        self.lm = lm
+        self.codec = codec
+        self.missing = missing
+        self.cache = {}
+    def cost(self,context,c):
+        """The cost of appending the code `c` to the string `context`."""
+        key = (context[-self.lm.N:],c)
+        result = self.cache.get(key)
+        if result is not None: return result
+        text = context
+        result = 0.0
+        s = u"".join(self.codec.decode([c]))
+        if s==u"~":
+            # rejects would be removed by lineproc, and the model's own
+            # "~" entry is smoothing mass, which is cheap in small models
+            result = self.missing
+        for char in self.lm.lineproc(s):
+            result += self.lm.getLogPosteriors(text).get(char,self.missing)
+            text += char
+        self.cache[key] = result
+        return result
+
+def decode_beam(outputs,beam=10,lm=None,codec=None,lweight=0.1,lbonus=0.0,
+                cutoff=1e-3,maxtime=None,pos=0):
+    """Translate back using CTC prefix beam search. This keeps the `beam`
+    best labelings (prefixes), summing over all the alignments that
+    collapse to the same labeling, rather than just taking the best class
+    in each region of the output.
+
+    If an `ocrolib.ngraphs` language model `lm` is given (this requires
+    the `codec`), each character added to a prefix is also scored by the
+    language model, weighted by `lweight`. Since this makes every character
+    cost something, `lbonus` is added to the (log) score for each character,
+    to compensate the bias towards deletions.
+
+    Only classes with a posterior of at least `cutoff` are considered at
+    each time step. If `maxtime` (in seconds) is given, the search falls
+    back to a beam of width 1 once that much time has been spent, which
+    bounds the time spent on a line. With `pos`, returns (time,class)
+    pairs like `translate_back`; the times come from `align_labels`."""
+    start = time.time()
+    scorer = None
+    if lm is not None:
+        scorer = NGraphsScorer(lm,codec,missing=lm.missing.get("~",15.0))
+    lp = log(maximum(outputs,1e-30))
+    candidates = [[int(c) for c in nonzero(o>=cutoff)[0] if c!=0] for o in outputs]
+    # Prefixes are nodes in a tree, identified by their index; for each,
+    # we keep the parent, the last label, the language model score, and
+    # the recent text (for the language model context).
+    parents,labels,lscores = [-1],[None],[0.0]
+    texts = [u"_"*lm.N] if lm is not None else None
+    children = {}
+    def child(i,c):
+        j = children.get((i,c))
+        if j is not None: return j
+        j = len(parents)
+        children[(i,c)] = j
+        parents.append(i)
+        labels.append(c)
+        if scorer is not None:
+            lscores.append(lscores[i]-lweight*scorer.cost(texts[i],c)+lbonus)
+            texts.append((texts[i]+u"".join(codec.decode([c])))[-2*lm.N:])
+        else:
+            lscores.append(0.0)
+        return j
+    # maps prefixes to the log probabilities of ending in blank and non-blank
+    beams = {0:(0.0,-inf)}
+    for t in range(len(outputs)):
+        if maxtime is not None and time.time()-start>maxtime: beam = 1
+        lpt = lp[t].tolist()
+        nbeams = {}
+        for i,(pb,pnb) in beams.items():
+            total = log_sum(pb,pnb)
+            # stay on the same labeling by emitting a blank...
+            e = nbeams.setdefault(i,[-inf,-inf])
+            e[0] = log_sum(e[0],total+lpt[0])
+            # ...or by repeating the last label
+            last = labels[i]
+            if last is not None:
+                e[1] = log_sum(e[1],pnb+lpt[last])
+            for c in candidates[t]:
+                e = nbeams.setdefault(child(i,c),[-inf,-inf])
+                if c==last:
+                    # a repeated label needs a blank in between
+                    e[1] = log_sum(e[1],pb+lpt[c])
+                else:
+                    e[1] = log_sum(e[1],total+lpt[c])
+        ranked = sorted(nbeams.items(),key=lambda x:-(log_sum(x[1][0],x[1][1])+lscores[x[0]]))
+        beams = dict(ranked[:beam])
+    i = max(beams.keys(),key=lambda i:log_sum(beams[i][0],beams[i][1])+lscores[i])
+    result = []
+    while i>0:
+        result.append(labels[i])
+        i = parents[i]
+    result = result[::-1]
+    if pos: return zip(align_labels(lp,result),result)
+    return result
+
+def align_labels(lp,labels):
+    """Find the best CTC alignment of the classes `labels` with the log
+    posteriors `lp` and return, for each label, the time step within
+    its aligned region at which it is most probable."""
+    if len(labels)==0: return []
+    # the usual CTC states: blanks interleaved with the labels
+    states = array([0]+[x for c in labels for x in (c,0)])
+    n = len(states)
+    # a blank may only be skipped between two different labels
+    skip = zeros(n,bool)
+    skip[3::2] = states[3::2]!=states[1:-2:2]
+    v = -inf*ones(n)
+    v[:2] = lp[0,states[:2]]
+    back = zeros((len(lp),n),'i')
+    for t in range(1,len(lp)):
+        stay = v
+        step = concatenate([[-inf],v[:-1]])
+        jump = where(skip,concatenate([[-inf,-inf],v[:-2]]),-inf)
+        choices = array([stay,step,jump])
+        back[t] = argmax(choices,axis=0)
+        v = choices[back[t],arange(n)]+lp[t,states]
+    s = n-1 if v[n-1]>=v[n-2] else n-2
+    path = zeros(len(lp),'i')
+    for t in range(len(lp)-1,-1,-1):
+        path[t] = s
+        s -= back[t,s]
+    result = []
+    for j,c in enumerate(labels):
+        frames = nonzero(path==2*j+1)[0]
+        result.append(int(frames[argmax(lp[frames,c])]))
+    return result
+
 def log_mul(x,y):
     "Perform multiplication in the log domain (i.e., addition)."
     return x+y
@@ -739,7 +1288,7 @@ def log_add(x,y):
     #return where(abs(x-y)>10,maximum(x,y),log(exp(x-y)+1)+y)
     return where(abs(x-y)>10,maximum(x,y),log(exp(clip(x-y,-20,20))+1)+y)
 
-def forward_algorithm(match,skip=-5.0):
+def forward_algorithm_py(match,skip=-5.0):
     """Apply the forward algorithm to an array of log state
     correspondence probabilities."""
     v = skip*arange(len(match[0]))
@@ -759,6 +1308,13 @@ def forward_algorithm(match,skip=-5.0):
         result.append(v)
     return array(result,'f')
 
+def forward_algorithm(match,skip=-5.0):
+    """Apply the forward algorithm to an array of log state
+    correspondence probabilities. This uses a native implementation
+    of `forward_algorithm_py`, since the recursion over time steps
+    is the inner loop of the CTC alignment."""
+    return array(nutils.forward_algorithm(match,skip),'f')
+
 def forwardbackward(lmatch):
     """Apply the forward-backward algorithm to an array of log state
     correspondence probabilities."""
@@ -839,6 +1395,10 @@ class SeqRecognizer:
         self.error_log = []
         self.cerror_log = []
         self.key_log = []
+    def trimLog(self,n):
+        """Keep only the last `n` entries of the training logs."""
+        for log in [self.error_log,self.cerror_log,self.key_log]:
+            del log[:-n]
     def __setstate__(self,state):
         self.__dict__.update(state)
         self.upgrade()
@@ -852,12 +1412,41 @@ class SeqRecognizer:
         self.net.info()
     def setLearningRate(self,r,momentum=0.9):
         self.lstm.setLearningRate(r,momentum)
+    def setDtype(self,dtype):
+        """Convert the network to the given `dtype`; use 'f' for single
+        precision inference. Inputs should be prepared with the same
+        `dtype` (see `prepare_line`)."""
+        self.lstm.setDtype(dtype)
+    def setConcurrent(self,flag):
+        """Run the two directions of the BIDILSTM in separate threads
+        for forward and backward propagation."""
+        self.lstm.setConcurrent(flag)
+    def strip(self):
+        """Remove the training history and all the training state of the
+        network, leaving only what is needed for recognition (weights,
+        codec, normalizer, and line normalizer)."""
+        vars = "outputs aligned targets error cerror"
+        vars += " batch_outputs batch_aligned batch_errors"
+        for v in vars.split():
+            self.__dict__.pop(v,None)
+        self.clear_log()
+        self.lstm.strip()
     def predictSequence(self,xs):
         "Predict an integer sequence of codes."
         assert xs.shape[1]==self.Ni,\
             "wrong image height (image: %d, expected: %d)"%(xs.shape[1],self.Ni)
         self.outputs = array(self.lstm.forward(xs))
         return translate_back(self.outputs)
+    def predictBatch(self,xss):
+        """Predict integer sequences of codes for a list of inputs at once.
+        The inputs may have different lengths; they are run through the
+        network together, and the outputs are translated back separately.
+        The network outputs for each input are left in `self.batch_outputs`."""
+        for xs in xss:
+            assert xs.shape[1]==self.Ni,\
+                "wrong image height (image: %d, expected: %d)"%(xs.shape[1],self.Ni)
+        self.batch_outputs = [array(o) for o in self.lstm.forward_batch(xss)]
+        return [translate_back(o) for o in self.batch_outputs]
     def trainSequence(self,xs,cs,update=1,key=None):
         "Train with an integer sequence of codes."
         assert xs.shape[1]==self.Ni,"wrong image height"
@@ -881,6 +1470,43 @@ class SeqRecognizer:
         # training keys
         self.key_log.append(key)
         return result
+    def trainBatch(self,xss,css,update=1,keys=None):
+        """Train with a list of inputs and integer code sequences as a single
+        mini-batch. Forward and backward propagation run over the whole batch
+        at once, the derivatives are summed over the batch, and the weights
+        are updated once. The outputs, alignments, and errors for the
+        individual sequences are left in `batch_outputs`, `batch_aligned`, and
+        `batch_errors`; `outputs`, `aligned`, and `error` refer to the last
+        sequence, as after `trainSequence`."""
+        if keys is None: keys = [None]*len(xss)
+        for xs in xss:
+            assert xs.shape[1]==self.Ni,"wrong image height"
+        # forward step
+        self.batch_outputs = [array(o) for o in self.lstm.forward_batch_train(xss)]
+        # CTC alignment
+        self.batch_aligned = []
+        for outputs,cs in zip(self.batch_outputs,css):
+            self.targets = array(make_target(cs,self.No))
+            aligned = ctc_align_targets(outputs,self.targets,debug=self.debug_align)
+            self.batch_aligned.append(array(aligned))
+        # propagate the deltas back
+        deltass = [a-o for a,o in zip(self.batch_aligned,self.batch_outputs)]
+        self.lstm.backward_batch(deltass)
+        if update: self.lstm.update()
+        results = []
+        self.batch_errors = []
+        for outputs,deltas,cs,key in zip(self.batch_outputs,deltass,css,keys):
+            result = translate_back(outputs)
+            results.append(result)
+            self.error = sum(deltas**2)
+            self.batch_errors.append(self.error)
+            self.error_log.append(self.error**.5/len(cs))
+            self.cerror = edist.levenshtein(cs,result)
+            self.cerror_log.append((self.cerror,len(cs)))
+            self.key_log.append(key)
+        self.outputs = self.batch_outputs[-1]
+        self.aligned = self.batch_aligned[-1]
+        return results
     # we keep track of errors within the object; this even gets
     # saved to give us some idea of the training history
     def errors(self,range=10000,smooth=0):
@@ -20,11 +20,31 @@ void sumprod(int r,int n,double out[n],double u[r][n],double v[r][n]) {
         out[i] = total;
     }
 }
+
+static inline double log_add(double x,double y) {
+    if(fabs(x-y)>10) return fmax(x,y);
+    double d = x-y;
+    if(d<-20) d = -20;
+    if(d>20) d = 20;
+    return log(exp(d)+1)+y;
+}
+
+void forward_algorithm(int n,int m,double out[n][m],double match[n][m],double skip) {
+    double v[m],w[m];
+    for(int j=0;j<m;j++) v[j] = skip*j;
+    for(int i=0;i<n;i++) {
+        w[0] = skip*i;
+        for(int j=1;j<m;j++) w[j] = v[j-1];
+        for(int j=0;j<m;j++) v[j] = log_add(v[j]+match[i][j],w[j]+match[i][j]);
+        for(int j=0;j<m;j++) out[i][j] = v[j];
+    }
+}
 """
 
 lstm_native = compile_and_load(lstm_utils)
 lstm_native.sumouter.argtypes = [I,I,I,A2D,A2D,A2D]
 lstm_native.sumprod.argtypes = [I,I,A1D,A2D,A2D]
+lstm_native.forward_algorithm.argtypes = [I,I,A2D,A2D,D]
 
 def sumouter(u,v,out=None):
     assert out.shape==u.shape[1:]+v.shape[1:] and u.shape[:1]==v.shape[:1]
@@ -35,7 +55,16 @@ def sumprod(u,v,out=None):
     lstm_native.sumprod(len(u),len(out),out,u,v)
     return out
 
+def forward_algorithm(match,skip=-5.0):
+    """Native version of `lstm.forward_algorithm_py`; the log-domain
+    additions are carried out exactly as in the Python version."""
+    match = numpy.ascontiguousarray(match,'d')
+    out = numpy.zeros(match.shape)
+    lstm_native.forward_algorithm(match.shape[0],match.shape[1],out,match,skip)
+    return out
+
 def test():
     from pylab import arange,zeros,randn
     sumouter(randn(11,3),randn(11,4),out=randn(3,4))
     sumprod(randn(11,7),randn(11,7),out=randn(7))
+    forward_algorithm(randn(11,7))